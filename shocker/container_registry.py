@@ -1,70 +1,171 @@
+from contextlib import contextmanager
+import fcntl
+import os
 from pathlib import Path
 import json
-from typing import Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 CONTAINERS_FILE = Path("/var/run/shocker/containers.json")
+LOCK_FILE = CONTAINERS_FILE.with_suffix(".lock")
+SUBNET_PREFIX = "69.69.0"
+FIRST_OCTET = 2  # .1 is the bridge
+LAST_OCTET = 254
 
 class ContainerRegistry:
+    # Parsed registry state, reused while the file's (inode, mtime) is unchanged
+    _cache: Optional[Dict[str, Any]] = None
+    _cache_key: Optional[Tuple[int, int]] = None
+    # Rendered hosts entries for the state under _hosts_cache_key; any save changes the key
+    _hosts_cache: str = ""
+    _hosts_cache_key: Optional[Tuple[int, int]] = None
     
     @staticmethod
-    def _load_containers() -> Dict[str, Dict[str, str]]:
-        """Load the containers from registry file."""
-        if not CONTAINERS_FILE.exists():
-            return {}
+    @contextmanager
+    def _locked():
+        """Serialize read-modify-write cycles across concurrent shocker processes."""
+        LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(LOCK_FILE, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    @staticmethod
+    def _load_state() -> Dict[str, Any]:
+        """Load the full registry state (containers plus IP allocator) from file."""
+        try:
+            st = CONTAINERS_FILE.stat()
+        except FileNotFoundError:
+            return {"containers": {}, "next_octet": FIRST_OCTET, "free_octets": [], "netns_pool": []}
+        
+        key = (st.st_ino, st.st_mtime_ns)
+        if ContainerRegistry._cache is not None and ContainerRegistry._cache_key == key:
+            return ContainerRegistry._cache
+        
         data = json.loads(CONTAINERS_FILE.read_text())
         # Support both old format (just dict) and new format (with 'containers' key)
         if isinstance(data, dict) and 'containers' in data:
-            return data['containers']
+            containers = data['containers']
+        else:
+            containers = data
+        if 'next_octet' not in data:
+            # Migrate: continue counting after the highest address still in use
+            used = [ContainerRegistry._octet(info) for info in containers.values()]
+            data = {
+                "containers": containers,
+                "next_octet": max(used, default=FIRST_OCTET - 1) + 1,
+                "free_octets": [],
+            }
+        data.setdefault('netns_pool', [])
+        
+        ContainerRegistry._cache = data
+        ContainerRegistry._cache_key = key
         return data
     
     @staticmethod
-    def _save_containers(containers: Dict[str, Dict[str, str]]):
-        """Save the containers to registry file."""
+    def _save_state(state: Dict[str, Any]):
+        """Atomically save the full registry state to file."""
         CONTAINERS_FILE.parent.mkdir(parents=True, exist_ok=True)
-        CONTAINERS_FILE.write_text(json.dumps(containers, indent=2))
+        tmp_file = CONTAINERS_FILE.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(state, separators=(',', ':')))
+        os.replace(tmp_file, CONTAINERS_FILE)
+        
+        st = CONTAINERS_FILE.stat()
+        ContainerRegistry._cache = state
+        ContainerRegistry._cache_key = (st.st_ino, st.st_mtime_ns)
+    
+    @staticmethod
+    def _octet(info: Dict[str, Any]) -> int:
+        """Last IP octet of a container entry (parsed from the IP for entries that predate 'octet')."""
+        if 'octet' in info:
+            return info['octet']
+        return int(info['ip'].split('.')[-1])
+    
+    @staticmethod
+    def _load_containers() -> Dict[str, Dict[str, str]]:
+        """Load the containers from registry file."""
+        return ContainerRegistry._load_state()['containers']
     
     @staticmethod
     def allocate_ip() -> str:
         """
-        Allocate the next available IP address by finding the highest
-        currently in use and incrementing.
+        Allocate an IP address, reusing a released one if available and
+        otherwise taking the next never-used address.
         """
-        containers = ContainerRegistry._load_containers()
-        
-        if not containers:
-            return "69.69.0.2"  # First container
+        with ContainerRegistry._locked():
+            state = ContainerRegistry._load_state()
         
-        # Extract all IPs and find the highest last octet
-        used_ips = []
-        for info in containers.values():
-            ip = info['ip']
-            last_octet = int(ip.split('.')[-1])
-            used_ips.append(last_octet)
+            if state['free_octets']:
+                octet = state['free_octets'].pop()
+            else:
+                octet = state['next_octet']
+                if octet > LAST_OCTET:
+                    raise RuntimeError(f"No free container IPs left in {SUBNET_PREFIX}.0/24")
+                state['next_octet'] = octet + 1
         
-        next_ip = max(used_ips) + 1
-        return f"69.69.0.{next_ip}"
+            ContainerRegistry._save_state(state)
+            return f"{SUBNET_PREFIX}.{octet}"
+    
+    @staticmethod
+    def release_ip(ip: str):
+        """Return an allocated IP address to the free list."""
+        with ContainerRegistry._locked():
+            state = ContainerRegistry._load_state()
+            octet = int(ip.split('.')[-1])
+            if octet not in state['free_octets']:
+                state['free_octets'].append(octet)
+            ContainerRegistry._save_state(state)
     
     @staticmethod
     def register(container_name: str, ip: str, netns: str):
         """Register a running container."""
-        containers = ContainerRegistry._load_containers()
+        with ContainerRegistry._locked():
+            state = ContainerRegistry._load_state()
+            containers = state['containers']
         
-        # Check if container name already exists
-        if container_name in containers:
-            raise ValueError(f"Container name '{container_name}' already exists. Choose a different name.")
+            # Check if container name already exists
+            if container_name in containers:
+                raise ValueError(f"Container name '{container_name}' already exists. Choose a different name.")
         
-        containers[container_name] = {
-            "ip": ip,
-            "netns": netns
-        }
-        ContainerRegistry._save_containers(containers)
+            containers[container_name] = {
+                "ip": ip,
+                "netns": netns,
+                "octet": int(ip.split('.')[-1])
+            }
+            ContainerRegistry._save_state(state)
     
     @staticmethod
     def unregister(container_name: str):
-        """Unregister a container."""
-        containers = ContainerRegistry._load_containers()
-        containers.pop(container_name, None)
-        ContainerRegistry._save_containers(containers)
+        """Unregister a container. Its IP stays allocated until release_ip()."""
+        with ContainerRegistry._locked():
+            state = ContainerRegistry._load_state()
+            state['containers'].pop(container_name, None)
+            ContainerRegistry._save_state(state)
+    
+    @staticmethod
+    def pool_push(netns: str, ip: str):
+        """Park a ready-to-use network namespace (and its IP) in the pool."""
+        with ContainerRegistry._locked():
+            state = ContainerRegistry._load_state()
+            state['netns_pool'].append({"netns": netns, "ip": ip})
+            ContainerRegistry._save_state(state)
+    
+    @staticmethod
+    def pool_pop() -> Optional[Dict[str, str]]:
+        """Take a namespace out of the pool, or None if it is empty."""
+        with ContainerRegistry._locked():
+            state = ContainerRegistry._load_state()
+            if not state['netns_pool']:
+                return None
+            entry = state['netns_pool'].pop()
+            ContainerRegistry._save_state(state)
+            return entry
+    
+    @staticmethod
+    def raw_state() -> Dict[str, Any]:
+        """Full registry state, including the IP allocator bookkeeping."""
+        return ContainerRegistry._load_state()
     
     @staticmethod
     def list_all() -> Dict[str, Dict[str, str]]:
@@ -80,8 +181,17 @@ class ContainerRegistry:
     @staticmethod
     def get_hosts_entries() -> str:
         """Get /etc/hosts entries for all containers."""
-        containers = ContainerRegistry.list_all()
+        state = ContainerRegistry._load_state()
+        # Only reusable while the state came from the (inode, mtime)-keyed cache
+        key = ContainerRegistry._cache_key if state is ContainerRegistry._cache else None
+        if key is not None and ContainerRegistry._hosts_cache_key == key:
+            return ContainerRegistry._hosts_cache
+        
         lines = []
-        for name, info in containers.items():
+        for name, info in state['containers'].items():
             lines.append(f"{info['ip']}\t{name}")
-        return "\n".join(lines)
\ No newline at end of file
+        hosts = "\n".join(lines)
+        
+        ContainerRegistry._hosts_cache = hosts
+        ContainerRegistry._hosts_cache_key = key
+        return hosts
\ No newline at end of file
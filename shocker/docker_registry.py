@@ -3,11 +3,62 @@
 Docker Registry API client for downloading image layers.
 """
 
+import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from shocker import layer_store
 
 ARTIFACTS_DIR = Path(__file__).parent.parent / "docker_artifacts"
+MAX_DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+MANIFEST_LIST_V2 = "application/vnd.docker.distribution.manifest.list.v2+json"
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+OCI_IMAGE_INDEX = "application/vnd.oci.image.index.v1+json"
+OCI_IMAGE_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+IMAGE_METADATA_FILE = "image.json"
+REGISTRY_CACHE_FILE = Path("/var/run/shocker/registry_cache.json")
+TOKEN_EXPIRY_MARGIN = 30  # seconds, refresh tokens a little before they actually expire
+
+def _dir_size(path: Path) -> int:
+    """Total size of all regular files under path, using cached DirEntry stat info."""
+    total = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+def _write_atomic(path: Path, text: str):
+    """Write a file through a uniquely named temp file and os.replace, so concurrent
+    writers never share a temp file and readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w") as f:
+            os.fchmod(f.fileno(), 0o644)
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
 
 class DockerRegistryClient:
     """Client for interacting with Docker Registry API v2.
@@ -15,39 +66,167 @@ class DockerRegistryClient:
     https://docs.docker.com/reference/api/registry/latest/#tag/pull
     """
 
+    # Tokens shared by all instances in this process, keyed by scope
+    _token_cache: Dict[str, Dict[str, Any]] = {}
+
     def __init__(self, repository: str, tag: str = "latest"):
         self.registry_url = "https://registry-1.docker.io"
         self.repository = f"library/{repository}"
         self.tag = tag
-        self.token = self._get_bearer_token()
+
+        # One pooled session so all manifest/blob requests reuse keep-alive connections
+        self.session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_DOWNLOAD_WORKERS, max_retries=retries))
+
+        # Token is only fetched once the first registry request needs it
+        self._token = None
+        self._token_lock = threading.Lock()
+        self.session.auth = self._bearer_auth
+        self.session.hooks["response"].append(self._reauth_on_401)
 
         if not ARTIFACTS_DIR.exists():
             ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
 
+    @property
+    def token(self) -> str:
+        """Bearer token for this repository, fetched lazily on first use."""
+        if self._token is None:
+            self._token = self._get_cached_token() or self._get_bearer_token()
+        return self._token
+
+    def _bearer_auth(self, request: requests.PreparedRequest) -> requests.PreparedRequest:
+        """Attach the bearer token to registry requests (not to the token endpoint itself)."""
+        if request.url.startswith(self.registry_url):
+            request.headers["Authorization"] = f"Bearer {self.token}"
+        return request
+
+    def _reauth_on_401(self, response: requests.Response, **kwargs) -> requests.Response:
+        """
+        Replay a registry request once with a fresh token when the current one was
+        rejected, e.g. a cached token that expired while the layers were downloading.
+        """
+        if response.status_code != 401 or not response.request.url.startswith(self.registry_url):
+            return response
+
+        # Download workers all hit the expiry together; only the first one refetches
+        rejected = response.request.headers.get("Authorization")
+        with self._token_lock:
+            if rejected == f"Bearer {self._token}":
+                DockerRegistryClient._token_cache.pop(self._scope, None)
+                self._token = self._get_bearer_token()
+            token = self._token
+
+        # Drain the 401 so its connection goes back to the pool
+        response.content
+        response.close()
+        retry = response.request.copy()
+        retry.headers["Authorization"] = f"Bearer {token}"
+        # Sent on the adapter directly, so this hook doesn't run again for the retry
+        new_response = response.connection.send(retry, **kwargs)
+        new_response.history.append(response)
+        new_response.request = retry
+        return new_response
+
+    @staticmethod
+    def _load_cache() -> Dict[str, Dict[str, Any]]:
+        """Load the token/manifest cache file (an unreadable cache counts as empty)."""
+        try:
+            data = json.loads(REGISTRY_CACHE_FILE.read_text())
+        except (OSError, ValueError):
+            return {"tokens": {}, "manifests": {}}
+        data.setdefault("tokens", {})
+        data.setdefault("manifests", {})
+        return data
+
+    @staticmethod
+    def _save_cache(cache: Dict[str, Dict[str, Any]]):
+        """Atomically save the token/manifest cache file."""
+        try:
+            REGISTRY_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            _write_atomic(REGISTRY_CACHE_FILE, json.dumps(cache, separators=(',', ':')))
+        except OSError:
+            pass  # Cache is best-effort, e.g. /var/run is not writable without sudo
+
+    @property
+    def _scope(self) -> str:
+        return f"repository:{self.repository}:pull"
+
+    @staticmethod
+    def _token_expiry(token: str) -> float:
+        """Read the exp claim from a JWT payload (no signature verification)."""
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except (IndexError, KeyError, ValueError):
+            return 0.0
+
+    def _get_cached_token(self) -> str | None:
+        """Return a still-valid bearer token from the in-process or on-disk cache, if any."""
+        now = time.time()
+        entry = DockerRegistryClient._token_cache.get(self._scope)
+        if entry and entry["exp"] - TOKEN_EXPIRY_MARGIN > now:
+            return entry["token"]
+
+        entry = self._load_cache()["tokens"].get(self._scope)
+        if entry and entry["exp"] - TOKEN_EXPIRY_MARGIN > now:
+            DockerRegistryClient._token_cache[self._scope] = entry
+            return entry["token"]
+        return None
+
     def _get_bearer_token(self) -> str:
         """Get a bearer token for the specified repository and return it."""
         params = {
             "service": "registry.docker.io",
-            "scope": f"repository:{self.repository}:pull"
+            "scope": self._scope
         }
         url = "https://auth.docker.io/token"
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
+        token = response.json()["token"]
+
+        entry = {"token": token, "exp": self._token_expiry(token)}
+        DockerRegistryClient._token_cache[self._scope] = entry
+        cache = self._load_cache()
+        cache["tokens"][self._scope] = entry
+        self._save_cache(cache)
         
-        return response.json()["token"]
+        return token
 
     def _get_manifest_list(self) -> Dict[str, Any]:
-        """Get the image manifest list."""
+        """
+        Get the manifest list for the tag, revalidating a cached copy via its ETag.
+        
+        May return a single image manifest (with "layers") if the tag isn't multi-platform.
+        """
+        # Offer single-image manifest types too: for single-platform images the
+        # registry then answers with the image manifest itself, saving a round-trip
         headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Accept": "application/vnd.docker.distribution.manifest.list.v2+json"
+            "Accept": ", ".join([
+                MANIFEST_LIST_V2, OCI_IMAGE_INDEX, MANIFEST_V2, OCI_IMAGE_MANIFEST
+            ])
         }
+
+        cache_key = f"{self.repository}:{self.tag}"
+        cache = self._load_cache()
+        cached = cache["manifests"].get(cache_key)
+        if cached:
+            headers["If-None-Match"] = cached["etag"]
         
         url = f"{self.registry_url}/v2/{self.repository}/manifests/{self.tag}"
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached["manifest"]
         response.raise_for_status()
+        manifest_list = response.json()
+
+        etag = response.headers.get("ETag")
+        if etag:
+            cache["manifests"][cache_key] = {"etag": etag, "manifest": manifest_list}
+            self._save_cache(cache)
         
-        return response.json()
+        return manifest_list
     
     def _get_platform_manifest_digest(self, manifest_list: Dict[str, Any], 
                                    architecture: str = "amd64", 
@@ -64,41 +243,87 @@ class DockerRegistryClient:
     def _get_image_manifest(self, digest: str) -> Dict[str, Any]:
         """Get the platform-specific image manifest."""
         headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Accept": "application/vnd.docker.distribution.manifest.v2+json"
+            "Accept": ", ".join([MANIFEST_V2, OCI_IMAGE_MANIFEST])
         }
 
         url = f"{self.registry_url}/v2/{self.repository}/manifests/{digest}"
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=headers)
         response.raise_for_status()
         
         return response.json()
 
-    def _check_blob_exists(self, digest: str) -> bool:
-        """Check if a blob exists using HEAD request."""
-        headers = {"Authorization": f"Bearer {self.token}"}
+    def _download_blob(self, digest: str, output_path: Path):
+        """
+        Stream a layer blob to output_path.
+        
+        Data lands in a .part file first; if one is left over from an interrupted
+        pull, only the missing tail is requested with a Range header.
+        """
+        partial_path = output_path.with_name(output_path.name + ".part")
+        offset = partial_path.stat().st_size if partial_path.exists() else 0
+        
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
 
         url = f"{self.registry_url}/v2/{self.repository}/blobs/{digest}"
-        response = requests.head(url, headers=headers)
-        
-        return response.status_code <= 400
+        with self.session.get(url, headers=headers, stream=True) as response:
+            # Range not satisfiable: the partial file already holds the whole blob
+            if response.status_code == 416 and offset:
+                with open(partial_path, "rb") as f:
+                    self._verify_digest(digest, hashlib.file_digest(f, "sha256"), partial_path)
+                os.replace(partial_path, output_path)
+                return
+            response.raise_for_status()
+            
+            # 206 means the server honoured the Range, 200 means start over
+            digest_hash = hashlib.sha256()
+            if response.status_code == 206:
+                mode = "ab"
+                with open(partial_path, "rb") as f:
+                    digest_hash = hashlib.file_digest(f, "sha256")
+            else:
+                mode = "wb"
 
-    def _download_blob(self, digest: str, output_path: Optional[Path] = None) -> bytes:
-        """Download a layer blob."""
-        headers = {"Authorization": f"Bearer {self.token}"}
+            # Hash inline while writing so the blob is only walked once, reusing
+            # one buffer instead of allocating a bytes object per chunk
+            buf = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+            raw = response.raw
+            raw.decode_content = True
+            with open(partial_path, mode) as f:
+                while n := raw.readinto(buf):
+                    digest_hash.update(buf[:n])
+                    f.write(buf[:n])
 
-        url = f"{self.registry_url}/v2/{self.repository}/blobs/{digest}"
-        response = requests.get(url, headers=headers, stream=True)
-        response.raise_for_status()
-        
-        content = b""
-        for chunk in response.iter_content(chunk_size=32768):
-            content += chunk
-        
-        if output_path:
-            output_path.write_bytes(content)
+        self._verify_digest(digest, digest_hash, partial_path)
+        os.replace(partial_path, output_path)
+
+    @staticmethod
+    def _verify_digest(digest: str, digest_hash, path: Path):
+        """Check a finished download against its sha256 digest, removing it on mismatch."""
+        expected = digest.split(":", 1)[1]
+        if digest_hash.hexdigest() != expected:
+            path.unlink(missing_ok=True)
+            raise ValueError(f"Digest mismatch for {digest}: got sha256:{digest_hash.hexdigest()}")
+
+    def _fetch_layer(self, i: int, layer: Dict[str, Any], total: int, output_dir: Path) -> str:
+        """Download a single layer into output_dir and return a status message."""
+        layer_digest = layer["digest"]
+        layer_filename = f"layer_{i:03d}_{layer_digest.replace(':', '_')}.tar.gz"
+        layer_path = output_dir / layer_filename
         
-        return content
+        # Local copy wins, no network round-trip needed
+        if layer_path.exists() and layer_path.stat().st_size > 0:
+            return f"[{i}/{total}] Layer already exists at {layer_path}, skipping download."
+
+        # No HEAD probe first: a missing blob shows up as a 404 on the GET itself
+        try:
+            self._download_blob(layer_digest, layer_path)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return f"[{i}/{total}] Warning: Layer {layer_digest} not found, skipping..."
+            raise
+        return f"[{i}/{total}] Layer saved to {layer_path}"
 
     def pull(self, output_dir: Path | None = None, download_layers: bool = True, 
              architecture: str = "amd64", os_type: str = "linux"):
@@ -120,40 +345,51 @@ class DockerRegistryClient:
         print("Getting manifest list...")
         manifest_list = self._get_manifest_list()
         
-        # Step 2: Get platform-specific digest
-        print(f"Finding {os_type}/{architecture} manifest...")
-        image_digest = self._get_platform_manifest_digest(manifest_list, architecture, os_type)
-        
-        # Step 3: Get platform-specific manifest
-        print("Getting platform-specific manifest...")
-        manifest = self._get_image_manifest(image_digest)
+        if "layers" in manifest_list:
+            # Registry already negotiated a single-platform manifest
+            manifest = manifest_list
+        else:
+            # Step 2: Get platform-specific digest
+            print(f"Finding {os_type}/{architecture} manifest...")
+            image_digest = self._get_platform_manifest_digest(manifest_list, architecture, os_type)
+            
+            # Step 3: Get platform-specific manifest
+            print("Getting platform-specific manifest...")
+            manifest = self._get_image_manifest(image_digest)
         
         # Step 4: Process layers
         if not manifest.get("layers"):
             raise ValueError("No layers found in manifest")
 
         if download_layers:
-            print(f"Downloading {len(manifest['layers'])} layers...")
-            for i, layer in enumerate(manifest["layers"], 1):
-                layer_digest = layer["digest"]
-                
-                # Check if layer exists
-                print(f"[{i}/{len(manifest['layers'])}] Checking layer {layer_digest}...")
-                if not self._check_blob_exists(layer_digest):
-                    print(f"Warning: Layer {layer_digest} not found, skipping...")
-                    continue
-                
-                # Download layer
-                print(f"[{i}/{len(manifest['layers'])}] Downloading layer {layer_digest}...")
-                layer_filename = f"layer_{i:03d}_{layer_digest.replace(':', '_')}.tar.gz"
-                layer_path = output_dir / layer_filename
-                
-                if layer_path.exists():
-                    print(f"Layer already exists at {layer_path}, skipping download.")
-                    continue
+            layers = manifest["layers"]
+            print(f"Downloading {len(layers)} layers...")
+            with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_WORKERS, len(layers))) as executor:
+                futures = [
+                    executor.submit(self._fetch_layer, i, layer, len(layers), output_dir)
+                    for i, layer in enumerate(layers, 1)
+                ]
+                for future in as_completed(futures):
+                    print(future.result())
+
+            # Sidecar metadata so list() doesn't have to parse folder names or walk layers
+            _write_atomic(output_dir / IMAGE_METADATA_FILE, json.dumps({
+                "repository": self.repository,
+                "tag": self.tag,
+                "size": sum(p.stat().st_size for p in output_dir.glob("layer_*.tar.gz")),
+                "layer_digests": [layer["digest"] for layer in layers],
+            }))
 
-                self._download_blob(layer_digest, layer_path)
-                print(f"Layer saved to {layer_path}")
+            # Unpack into the layer store now, so run doesn't pay for gunzip + untar.
+            # Only as root: the store keeps the images' numeric uids/gids, which a
+            # non-root tar can't set, and run trusts whatever it finds there
+            layer_files = sorted(output_dir.glob("layer_*.tar.gz"))
+            if os.geteuid() == 0 and layer_files:
+                try:
+                    with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(layer_files))) as executor:
+                        list(executor.map(layer_store.unpack, layer_files))
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(f"Warning: could not unpack layers ahead of time, run will do it: {e}")
         
         print(f"\nPull completed!")
         print(f"Repository: {self.repository}:{self.tag}")
@@ -168,9 +404,19 @@ class DockerRegistryClient:
             return []
         
         images = []
-        for item in ARTIFACTS_DIR.iterdir():
-            if item.is_dir():
-                # Extract repo and tag from folder name
+        # Single directory scan; DirEntry.is_dir() uses the d_type from readdir, no stat
+        with os.scandir(ARTIFACTS_DIR) as it:
+            entries = [Path(entry.path) for entry in it if entry.is_dir()]
+        
+        for item in entries:
+            try:
+                metadata = json.loads((item / IMAGE_METADATA_FILE).read_text())
+                repo = metadata["repository"]
+                tag = metadata["tag"]
+                total_size = metadata["size"]
+            except (OSError, ValueError, KeyError, TypeError):
+                # Legacy pull without metadata (or an unreadable one): extract repo
+                # and tag from folder name
                 folder_name = item.name
                 if "_" in folder_name:
                     parts = folder_name.rsplit("_", 1)
@@ -181,19 +427,16 @@ class DockerRegistryClient:
                     tag = "unknown"
                 
                 # Calculate total size of all files in the directory
-                total_size = 0
-                for file_path in item.rglob("*"):
-                    if file_path.is_file():
-                        total_size += file_path.stat().st_size
-                
-                # Convert to MB
-                size_mb = total_size / (1024 * 1024)
-                
-                images.append({
-                    "repository": repo,
-                    "tag": tag,
-                    "path": item,
-                    "size_mb": round(size_mb, 2)
-                })
+                total_size = _dir_size(item)
+            
+            # Convert to MB
+            size_mb = total_size / (1024 * 1024)
+            
+            images.append({
+                "repository": repo,
+                "tag": tag,
+                "path": item,
+                "size_mb": round(size_mb, 2)
+            })
 
         return images
@@ -0,0 +1,98 @@
+"""
+Content-addressed store of unpacked image layers.
+
+Every layer blob is unpacked once into LAYERS_DIR/<digest>/ and then shared by
+all containers that use it. A container's root filesystem is an overlayfs mount
+with the layers as read-only lower dirs, so starting a container copies nothing
+and a second `run` of the same image skips decompression and extraction entirely.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import List
+
+LAYERS_DIR = Path("/var/lib/shocker/layers")
+
+# pigz inflates faster than gzip (CRC and I/O on helper threads)
+PIGZ = shutil.which("pigz")
+
+
+def layer_digest(layer_file: Path) -> str:
+    """Digest part of a pulled layer_NNN_sha256_<hex>.tar.gz file name."""
+    return layer_file.name.removesuffix(".tar.gz").split("_", 2)[2]
+
+
+def unpack(layer_file: Path) -> Path:
+    """Return the unpacked directory of a layer, unpacking it on first use."""
+    layer_dir = LAYERS_DIR / layer_digest(layer_file)
+    if layer_dir.is_dir():
+        return layer_dir
+
+    print(f"📦 Unpacking layer {layer_dir.name}...")
+
+    # Unpack next to the final location and rename it into place, so a crash
+    # never leaves a half-unpacked layer that later runs would trust
+    LAYERS_DIR.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f".{layer_dir.name}.", dir=LAYERS_DIR))
+    try:
+        os.chmod(staging, 0o755)
+        # GNU tar unpacks in C; keep the image's numeric uids/gids
+        decompress = ['-I', PIGZ] if PIGZ else ['-z']
+        subprocess.run([
+            'tar', '--numeric-owner', *decompress, '-xf', str(layer_file), '-C', str(staging)
+        ], check=True)
+        try:
+            staging.rename(layer_dir)
+        except OSError:
+            if not layer_dir.is_dir():
+                raise
+            # A concurrent run unpacked the same layer first
+            subprocess.run(['rm', '-rf', str(staging)], check=False)
+    except BaseException:
+        subprocess.run(['rm', '-rf', str(staging)], check=False)
+        raise
+    return layer_dir
+
+
+def mount_rootfs(layer_dirs: List[Path], container_dir: Path) -> Path:
+    """
+    Compose the layers (bottom first) into container_dir/rootfs. Writes go to
+    container_dir/upper, the shared layers are never modified. Falls back to
+    copying the layers if overlayfs is unavailable.
+    """
+    rootfs, upper, work = (container_dir / name for name in ("rootfs", "upper", "work"))
+    for d in (rootfs, upper, work):
+        d.mkdir()
+
+    # overlayfs lists the topmost layer first
+    lowerdir = ":".join(str(d) for d in reversed(layer_dirs))
+    result = subprocess.run([
+        'mount', '-t', 'overlay', 'overlay',
+        '-o', f'lowerdir={lowerdir},upperdir={upper},workdir={work}', str(rootfs)
+    ], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"⚠️  overlayfs mount failed ({result.stderr.strip()}), copying layers instead")
+        for layer_dir in layer_dirs:
+            # Reflinks make this nearly free on btrfs/xfs
+            subprocess.run(['cp', '-a', '--reflink=auto', f"{layer_dir}/.", str(rootfs)], check=True)
+    return rootfs
+
+
+def unmount_rootfs(rootfs: Path) -> bool:
+    """
+    Unmount a rootfs from mount_rootfs (a no-op for the copied fallback).
+    Returns False if the overlay is still in use, e.g. by a process the container
+    left running: it is then only detached lazily and its upper and work dirs
+    must stay until the kernel drops it.
+    """
+    if not os.path.ismount(rootfs):
+        return True
+    result = subprocess.run(['umount', str(rootfs)], capture_output=True, text=True)
+    if result.returncode == 0:
+        return True
+    print(f"⚠️  Could not unmount {rootfs} ({result.stderr.strip()}), detaching it lazily")
+    subprocess.run(['umount', '-l', str(rootfs)], capture_output=True, check=False)
+    return False
@@ -1,9 +1,8 @@
 import click
+import json
 from pathlib import Path
-from shocker.docker_registry import DockerRegistryClient
-from shocker.run import run_container
 
-@click.group()
+@click.group(context_settings={'auto_envvar_prefix': 'SHOCKER'})
 def cli():
     """Shocker - A simple Docker-like container runner."""
     pass
@@ -14,6 +13,8 @@ def cli():
 @click.option('--os-type', default='linux', help='Target OS (default: linux)')
 def pull(repository: str, architecture: str, os_type: str):
     """Pull a Docker image from the registry."""
+    from shocker.docker_registry import DockerRegistryClient
+
     tag = 'latest'
     if ':' in repository:
         repository, tag = repository.split(':', 1)
@@ -27,9 +28,11 @@ def pull(repository: str, architecture: str, os_type: str):
     click.echo(f"✅ Successfully pulled {repository}:{tag}")
 
 
-@cli.command()
-def list():
+@cli.command(name='list')
+def list_images():
     """List all pulled images."""
+    from shocker.docker_registry import DockerRegistryClient
+
     images = DockerRegistryClient.list()
     
     if not images:
@@ -43,6 +46,40 @@ def list():
         click.echo(f"  Path: {img['path']}")
         click.echo()
 
+@cli.command()
+@click.option('--raw', is_flag=True, help='Pretty-print the raw container registry file')
+def ps(raw: bool):
+    """List running named containers."""
+    from shocker.container_registry import ContainerRegistry
+
+    if raw:
+        click.echo(json.dumps(ContainerRegistry.raw_state(), indent=2))
+        return
+
+    containers = ContainerRegistry.list_all()
+    if not containers:
+        click.echo("No running containers.")
+        return
+
+    click.echo(f"{'NAME':<20} {'IP':<16} NETNS")
+    for name, info in containers.items():
+        click.echo(f"{name:<20} {info['ip']:<16} {info['netns']}")
+
+@cli.command()
+@click.argument('count', type=int, default=1)
+@click.option('--drain', is_flag=True, help='Tear down all pre-warmed namespaces instead')
+def prewarm(count: int, drain: bool):
+    """Pre-create COUNT network namespaces for faster container starts."""
+    from shocker import netns_pool
+
+    if drain:
+        netns_pool.drain()
+        click.echo("✅ Drained network namespace pool")
+        return
+
+    netns_pool.prewarm(count)
+    click.echo(f"✅ Pre-warmed {count} network namespace(s)")
+
 @cli.command()
 @click.argument('image')
 @click.argument('command', nargs=-1)
@@ -64,6 +101,9 @@ def run(image, command, port, name):
         else:
             port_mappings.append((int(p), int(p)))
 
+    # Imported here so pull/list don't pay for pyroute2 and friends
+    from shocker.run import run_container
+
     run_container(repository, tag, command, 
                   port_mappings=port_mappings,
                   container_name=name)
@@ -0,0 +1,94 @@
+"""
+Pool of pre-wired network namespaces.
+
+`shocker prewarm N` creates namespaces that are already connected to the bridge
+and addressed, so `run` can skip the netns/veth/bridge setup on the hot path.
+Pooled namespaces keep their IP for their whole lifetime; after a container
+exits its namespace is reset and parked again instead of being torn down.
+"""
+
+from typing import NamedTuple
+
+from shocker.container_registry import ContainerRegistry
+from shocker.networking import (
+    NETNS_DIR,
+    NetConfig,
+    cleanup_network_namespace,
+    ensure_bridge_exists,
+    net_config,
+    netns_in_use,
+    reset_network_namespace,
+    setup_network_namespace,
+)
+
+
+class ContainerNetwork(NamedTuple):
+    """A network namespace handed out to a container."""
+    netns_name: str
+    container_ip: str
+    cfg: NetConfig
+    pooled: bool
+
+
+def _create(netns_name: str, container_ip: str) -> NetConfig:
+    """Set up a namespace for an already allocated IP, giving the IP back on failure."""
+    cfg = net_config(container_ip)
+    try:
+        setup_network_namespace(netns_name, container_ip, cfg)
+    except Exception:
+        ContainerRegistry.release_ip(container_ip)
+        raise
+    return cfg
+
+
+def prewarm(count: int):
+    """Create count namespaces and park them in the pool."""
+    for _ in range(count):
+        container_ip = ContainerRegistry.allocate_ip()
+        netns_name = f"shocker-pool-{container_ip.rsplit('.', 1)[1]}"
+        _create(netns_name, container_ip)
+        ContainerRegistry.pool_push(netns_name, container_ip)
+        print(f"♨️  Pre-warmed network namespace {netns_name} ({container_ip})")
+
+
+def drain():
+    """Tear down every pooled namespace and release its IP."""
+    while entry := ContainerRegistry.pool_pop():
+        cleanup_network_namespace(entry['netns'], net_config(entry['ip']))
+        ContainerRegistry.release_ip(entry['ip'])
+
+
+def acquire(fallback_netns_name: str) -> ContainerNetwork:
+    """Take a pooled namespace, or create fallback_netns_name if the pool is empty."""
+    while entry := ContainerRegistry.pool_pop():
+        if (NETNS_DIR / entry['netns']).exists():
+            # Bridge forwarding rules may have been flushed since the pool was filled
+            ensure_bridge_exists()
+            print(f"♨️  Using pre-warmed network namespace {entry['netns']}")
+            return ContainerNetwork(entry['netns'], entry['ip'], net_config(entry['ip']), True)
+        # Namespace vanished (removed by hand), drop it from the pool
+        ContainerRegistry.release_ip(entry['ip'])
+
+    container_ip = ContainerRegistry.allocate_ip()
+    cfg = _create(fallback_netns_name, container_ip)
+    return ContainerNetwork(fallback_netns_name, container_ip, cfg, False)
+
+
+def release(network: ContainerNetwork):
+    """
+    Give a namespace back: pooled ones are reset and parked, others torn down.
+    A pooled namespace that still has processes in it (e.g. something the container
+    started in the background) is torn down too, so no other container ever shares it.
+    """
+    if network.pooled and netns_in_use(network.netns_name):
+        print(f"⚠️  Processes still running in {network.netns_name}, removing it from the pool")
+    elif network.pooled:
+        try:
+            reset_network_namespace(network.netns_name, network.container_ip, network.cfg)
+            ContainerRegistry.pool_push(network.netns_name, network.container_ip)
+            return
+        except Exception as e:
+            print(f"⚠️  Could not reset {network.netns_name}, removing it from the pool: {e}")
+
+    cleanup_network_namespace(network.netns_name, network.cfg)
+    ContainerRegistry.release_ip(network.container_ip)
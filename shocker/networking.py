@@ -1,124 +1,220 @@
+import atexit
+import os
 from pathlib import Path
-import shutil
+import socket
 import subprocess
-from typing import List
-from pyroute2 import IPRoute, NetNS, netns
+from typing import Dict, List, NamedTuple
+from pyroute2 import IPRoute, netns
 from pyroute2.netlink.exceptions import NetlinkError
+from pyroute2.netlink.rtnl import ndmsg
 
 # Simple bridge configuration
 BRIDGE_NAME = "shocker0"
 BRIDGE_IP = "69.69.0.1"
+# Fixed bridge MAC: an explicitly set address stops the kernel from re-picking
+# it as ports come and go, so containers can keep a static ARP entry for it
+BRIDGE_MAC = "02:42:45:00:01:01"
+BRIDGE_SUBNET = "69.69.0.0/24"
+PORTS_IPSET = "shocker_ports"
+FORWARD_CHAIN = "SHOCKER_FWD"
+NETNS_DIR = Path("/var/run/netns")
+LOOPBACK_IDX = 1
 
-def ensure_bridge_exists():
-    """Create and configure the shocker bridge if it doesn't exist."""
+# Bridge ifindex, set once the bridge is known to exist in this process
+_BRIDGE_IDX: int | None = None
+
+# One netlink socket for the whole process, opened on first use
+_ipr = None
+
+# Whether published ports can be matched through PORTS_IPSET (needs the ipset
+# tool and the xt_set iptables match), decided once per process
+_ports_ipset_ok: bool | None = None
+
+def _get_ipr() -> IPRoute:
+    """Return the shared IPRoute socket, opening it on first use."""
+    global _ipr
+    if _ipr is None:
+        _ipr = IPRoute(strict_check=True)
+        atexit.register(_ipr.close)
+    return _ipr
+
+def _sysctl(key: str, value: str):
+    """Set a sysctl by writing /proc/sys directly instead of forking sysctl(8)."""
     try:
-        with IPRoute() as ipr:
-            # Check if bridge already exists
-            try:
-                bridge_idx = ipr.link_lookup(ifname=BRIDGE_NAME)[0]
-                print(f"🌉 Bridge {BRIDGE_NAME} already exists")
-                enable_bridge_forwarding()  # Add this line
-                return
-            except IndexError:
-                pass  # Bridge doesn't exist, create it
-            
-            # Create bridge
-            ipr.link('add', ifname=BRIDGE_NAME, kind='bridge')
-            bridge_idx = ipr.link_lookup(ifname=BRIDGE_NAME)[0]
-            
-            # Configure bridge IP
-            ipr.addr('add', index=bridge_idx, address=BRIDGE_IP, prefixlen=24)
-            ipr.link('set', index=bridge_idx, state='up')
-            
-            enable_bridge_forwarding()  # Add this line too
-            
-            print(f"🌉 Created bridge {BRIDGE_NAME} at {BRIDGE_IP}/24")
+        Path("/proc/sys", *key.split('.')).write_text(value)
+    except OSError as e:
+        print(f"⚠️  Failed to set {key}={value}: {e}")
+
+def _idx(ipr, ifname: str) -> int:
+    """
+    Interface index by name. Unlike link_lookup, which dumps every link and
+    filters in Python, this is a single kernel-side RTM_GETLINK lookup.
+    Raises NetlinkError if the interface doesn't exist.
+    """
+    return ipr.link('get', ifname=ifname)[0]['index']
+
+def ensure_bridge_exists() -> int:
+    """Create and configure the shocker bridge if it doesn't exist. Returns its ifindex."""
+    global _BRIDGE_IDX
+    if _BRIDGE_IDX is not None:
+        return _BRIDGE_IDX
+    
+    # Check if bridge already exists with a cheap sysfs stat instead of a netlink round-trip
+    bridge_sysfs = Path("/sys/class/net", BRIDGE_NAME)
+    if bridge_sysfs.exists():
+        print(f"🌉 Bridge {BRIDGE_NAME} already exists")
+        # Bridges created by older versions don't have the fixed MAC yet
+        bridge_idx = int((bridge_sysfs / "ifindex").read_text())
+        if (bridge_sysfs / "address").read_text().strip() != BRIDGE_MAC:
+            _get_ipr().link('set', index=bridge_idx, address=BRIDGE_MAC)
+        enable_bridge_forwarding()
+        _BRIDGE_IDX = bridge_idx
+        return bridge_idx
+    
+    try:
+        ipr = _get_ipr()
+        
+        # Create bridge
+        ipr.link('add', ifname=BRIDGE_NAME, kind='bridge', address=BRIDGE_MAC)
+        bridge_idx = _idx(ipr, BRIDGE_NAME)
+        
+        # Configure bridge IP
+        ipr.addr('add', index=bridge_idx, address=BRIDGE_IP, prefixlen=24)
+        ipr.link('set', index=bridge_idx, state='up')
+        
+        enable_bridge_forwarding()  # Add this line too
+        
+        print(f"🌉 Created bridge {BRIDGE_NAME} at {BRIDGE_IP}/24")
+        _BRIDGE_IDX = bridge_idx
+        return bridge_idx
             
     except Exception as e:
         print(f"❌ Failed to create bridge: {e}")
         raise
 
-def setup_network_namespace(netns_name: str, container_ip: str) -> str:
+class NetConfig(NamedTuple):
+    """Interface names and MAC derived from a container's IP."""
+    veth_host: str
+    veth_container: str
+    mac: str
+
+def net_config(container_ip: str) -> NetConfig:
+    """Compute all per-container interface names once, for both setup and cleanup."""
+    # MAC from the last two IP octets: 02:42:45:XX:XX:00 (Docker-style, locally administered)
+    ip_bytes = socket.inet_aton(container_ip)
+    mac = bytes((0x02, 0x42, 0x45, ip_bytes[2], ip_bytes[3], 0x00)).hex(':')
+    return NetConfig(
+        # The registry hands out each IP octet to one live container at a time,
+        # so it doubles as a collision-free veth id (fits IFNAMSIZ)
+        veth_host=f"veth-shk{ip_bytes[3]}",
+        veth_container="eth0",  # Standard container interface name
+        mac=mac,
+    )
+
+def _configure_container_end(ns: IPRoute, container_ip: str, cfg: NetConfig):
+    """Address the container's veth end, bring links up and add the gateway route."""
+    container_idx = _idx(ns, cfg.veth_container)
+    ns.addr('add', index=container_idx, address=container_ip, prefixlen=24)
+    ns.link('set', index=container_idx, state='up')
+    
+    # Set up loopback (always ifindex 1 in a namespace, no lookup needed)
+    ns.link('set', index=LOOPBACK_IDX, state='up')
+    
+    # Add default route via bridge
+    ns.route('replace', dst='default', gateway=BRIDGE_IP)
+    
+    # Static ARP entry for the gateway, no broadcast needed to find it
+    ns.neigh('set', dst=BRIDGE_IP, lladdr=BRIDGE_MAC, ifindex=container_idx,
+             state=ndmsg.states['permanent'])
+
+def setup_network_namespace(netns_name: str, container_ip: str, cfg: NetConfig | None = None) -> str:
     """
     Create and configure a network namespace with bridge connection.
     Returns the namespace name.
     """
+    if cfg is None:
+        cfg = net_config(container_ip)
+    veth_host, veth_container, mac_address = cfg
+    
     try:
         # Ensure bridge exists
-        ensure_bridge_exists()
+        bridge_idx = ensure_bridge_exists()
         
         # Create network namespace
         netns.create(netns_name)
         print(f"🌐 Created network namespace: {netns_name}")
         
-        # Create veth pair with unique names
-        veth_host = f"veth-{netns_name[-8:]}"  # Use last 8 chars of netns name
-        veth_container = "eth0"  # Standard container interface name
+        ipr = _get_ipr()
         
-        with IPRoute() as ipr:
-            # Create veth pair
-            ipr.link('add', ifname=veth_host, peer=veth_container, kind='veth')
-            
-            # Get the container end's interface index before moving it
-            container_idx = ipr.link_lookup(ifname=veth_container)[0]
-            
-            # Generate a unique MAC address based on the container IP
-            # Format: 02:42:AC:XX:XX:XX (Docker-style, locally administered)
-            ip_parts = container_ip.split('.')
-            mac_address = f"02:42:45:{int(ip_parts[2]):02x}:{int(ip_parts[3]):02x}:00"
-            
-            # Set MAC address before moving to namespace
-            ipr.link('set', index=container_idx, address=mac_address)
-            
-            # Move container end to namespace
-            ipr.link('set', index=container_idx, net_ns_fd=netns_name)
-            
-            # Connect host end to bridge
-            bridge_idx = ipr.link_lookup(ifname=BRIDGE_NAME)[0]
-            veth_host_idx = ipr.link_lookup(ifname=veth_host)[0]
-            ipr.link('set', index=veth_host_idx, master=bridge_idx, state='up')
-            
-            # Enable hairpin mode and learning on the veth
-            subprocess.run(['bridge', 'link', 'set', 'dev', veth_host, 'hairpin', 'on'], check=False)
-            subprocess.run(['bridge', 'link', 'set', 'dev', veth_host, 'learning', 'on'], check=False)
+        # Create the veth pair in a single RTM_NEWLINK: the peer is created with
+        # its MAC directly inside the namespace, and the host end is enslaved to
+        # the bridge and brought up by the same message
+        ipr.link('add', ifname=veth_host, kind='veth', master=bridge_idx, state='up',
+                 peer={'ifname': veth_container, 'address': mac_address, 'net_ns_fd': netns_name})
+        veth_host_idx = _idx(ipr, veth_host)
         
-        # Configure container end inside namespace with dynamic IP
-        with NetNS(netns_name) as ns:
-            container_idx = ns.link_lookup(ifname=veth_container)[0]
-            ns.addr('add', index=container_idx, address=container_ip, prefixlen=24)
-            ns.link('set', index=container_idx, state='up')
-            
-            # Set up loopback
-            lo_idx = ns.link_lookup(ifname='lo')[0]
-            ns.link('set', index=lo_idx, state='up')
-            
-            # Add default route via bridge
-            ns.route('add', dst='default', gateway=BRIDGE_IP)
+        # Enable hairpin mode and learning on the veth (IFLA_BRPORT_MODE / _LEARNING)
+        ipr.brport('set', index=veth_host_idx, mode=1, learning=1)
         
-        # Send gratuitous ARP to populate bridge fdb
-        subprocess.run([
-            'ip', 'netns', 'exec', netns_name,
-            'ping', '-c', '1', '-W', '1', BRIDGE_IP
-        ], check=False, capture_output=True)
+        # Seed the bridge FDB with the container MAC so nothing has to be learned from
+        # traffic (`bridge fdb append ... master static`). NTF_MASTER targets the
+        # bridge rather than the veth's own filter; NUD_NOARP makes it static, where
+        # the default NUD_PERMANENT would mark it local and deliver to the host
+        ipr.fdb('append', ifindex=veth_host_idx, lladdr=mac_address,
+                flags=ndmsg.flags['master'], state=ndmsg.states['noarp'])
+        
+        # Configure container end inside namespace with dynamic IP. The namespace
+        # already exists (flags=0), so this is just one strict-checking socket in it
+        with IPRoute(netns=netns_name, flags=0, strict_check=True) as ns:
+            _configure_container_end(ns, container_ip, cfg)
         
         print(f"🔗 Container connected to bridge: {container_ip} → {BRIDGE_NAME}")
         return netns_name
         
     except Exception as e:
         print(f"❌ Failed to setup network namespace: {e}")
-        cleanup_network_namespace(netns_name)
+        cleanup_network_namespace(netns_name, cfg)
         raise
 
-def cleanup_network_namespace(netns_name: str):
+def netns_in_use(netns_name: str) -> bool:
+    """Whether any process is still running inside the named network namespace."""
+    try:
+        ns = os.stat(NETNS_DIR / netns_name)
+    except FileNotFoundError:
+        return False
+    with os.scandir("/proc") as it:
+        for entry in it:
+            if not entry.name.isdigit():
+                continue
+            try:
+                st = os.stat(f"/proc/{entry.name}/ns/net")
+            except OSError:
+                continue  # Process exited meanwhile, or a kernel thread
+            if (st.st_dev, st.st_ino) == (ns.st_dev, ns.st_ino):
+                return True
+    return False
+
+def reset_network_namespace(netns_name: str, container_ip: str, cfg: NetConfig):
+    """
+    Return a used namespace to its freshly-set-up state so it can be reused:
+    the container ran as root in it and may have changed addresses or routes.
+    
+    Only eth0's addresses and the main routing table are reset. Netfilter rules,
+    sysctls, extra links or other routing tables a container set up inside the
+    namespace carry over to the next container that gets it.
+    """
+    with IPRoute(netns=netns_name, flags=0, strict_check=True) as ns:
+        ns.flush_addr(index=_idx(ns, cfg.veth_container))
+        ns.flush_routes(table=254)  # RT_TABLE_MAIN
+        _configure_container_end(ns, container_ip, cfg)
+
+def cleanup_network_namespace(netns_name: str, cfg: NetConfig):
     """Clean up network namespace and associated resources."""
     try:
-        # Remove veth interface with unique name
-        veth_host = f"veth-{netns_name[-8:]}"
+        # Remove veth interface with unique name. The kernel resolves IFLA_IFNAME
+        # itself on delete, so no index lookup round-trip is needed
         try:
-            with IPRoute() as ipr:
-                host_idx = ipr.link_lookup(ifname=veth_host)
-                if host_idx:
-                    ipr.link('del', index=host_idx[0])
+            _get_ipr().link('del', ifname=cfg.veth_host)
         except:
             pass
         
@@ -133,6 +229,18 @@ def cleanup_network_namespace(netns_name: str):
         print(f"⚠️  Error during network cleanup: {e}")
 
 
+# Static part of every container's /etc/hosts
+_HOSTS_PREAMBLE = (
+    b"127.0.0.1\tlocalhost\n"
+    b"::1\t\tlocalhost ip6-localhost ip6-loopback\n"
+    b"fe00::0\t\tip6-localnet\n"
+    b"ff00::0\t\tip6-mcastprefix\n"
+    b"ff02::1\t\tip6-allnodes\n"
+    b"ff02::2\t\tip6-allrouters\n"
+    b"\n"
+    b"# Container hostnames\n"
+)
+
 def setup_dns(root_path, container_name: str = None):
     """Setup DNS and hosts file for container."""
     from shocker.container_registry import ContainerRegistry
@@ -144,151 +252,168 @@ def setup_dns(root_path, container_name: str = None):
     # Ensure etc directory exists
     container_resolv.parent.mkdir(parents=True, exist_ok=True)
     
-    # Copy DNS configuration
+    # Copy DNS configuration (a few hundred bytes, no need for copy2's metadata calls)
     if host_resolv.exists():
-        shutil.copy2(host_resolv, container_resolv)
-    
-    # Build hosts file with standard entries + all containers
-    hosts_content = [
-        "127.0.0.1\tlocalhost",
-        "::1\t\tlocalhost ip6-localhost ip6-loopback",
-        "fe00::0\t\tip6-localnet",
-        "ff00::0\t\tip6-mcastprefix",
-        "ff02::1\t\tip6-allnodes",
-        "ff02::2\t\tip6-allrouters",
-        "",
-        "# Container hostnames",
-    ]
+        container_resolv.write_bytes(host_resolv.read_bytes())
     
-    # Add all registered containers
+    # Hosts file with standard entries + all registered containers
     container_entries = ContainerRegistry.get_hosts_entries()
     if container_entries:
-        hosts_content.append(container_entries)
-    
-    container_hosts.write_text("\n".join(hosts_content) + "\n")
+        container_hosts.write_bytes(_HOSTS_PREAMBLE + container_entries.encode() + b"\n")
+    else:
+        container_hosts.write_bytes(_HOSTS_PREAMBLE)
     
     print(f"📡 Configured DNS and hosts for container")
     if container_entries:
-        print(f"   Added {len(ContainerRegistry.list_all())} container hostname(s)")
+        print(f"   Added {len(container_entries.splitlines())} container hostname(s)")
 
-def setup_port_forwarding(port_mappings: List[tuple[int, int]], container_ip: str):
-    """Set up port forwarding using iptables for localhost access."""
-    
-    # Enable route_localnet to allow DNAT from localhost to work properly
-    subprocess.run([
-        'sysctl', '-w', 'net.ipv4.conf.lo.route_localnet=1'
-    ], check=False)
-    
-    subprocess.run([
-        'sysctl', '-w', 'net.ipv4.conf.all.route_localnet=1'
-    ], check=False)
-    
+def _ensure_ports_ipset() -> bool:
+    """Create PORTS_IPSET if needed. Returns False if ipset is not available on this host."""
+    global _ports_ipset_ok
+    if _ports_ipset_ok is None:
+        try:
+            result = subprocess.run(['ipset', 'create', PORTS_IPSET, 'hash:ip,port', '-exist'],
+                                    capture_output=True, text=True)
+            _ports_ipset_ok = result.returncode == 0
+            error = result.stderr.strip()
+        except FileNotFoundError:
+            _ports_ipset_ok = False
+            error = "ipset is not installed"
+        if not _ports_ipset_ok:
+            print(f"⚠️  {error}, falling back to per-port FORWARD rules")
+    return _ports_ipset_ok
+
+def _port_forwarding_rules(port_mappings: List[tuple[int, int]], container_ip: str) -> List[tuple[str, List[str]]]:
+    """Return (table, rule) pairs for the port forwarding of a container, in insertion order."""
+    # With ipset, FORWARD acceptance is handled by the static PORTS_IPSET rules,
+    # see enable_bridge_forwarding
+    use_ipset = _ensure_ports_ipset()
+    rules = []
     for host_port, container_port in port_mappings:
-        # FORWARD rules - insert AFTER the bridge rules (position 3 or higher)
-        # Find the position after bridge rules
-        subprocess.run([
-            "iptables", "-A", "FORWARD",  # Changed from -I to -A (append)
-            "-d", container_ip, "-p", "tcp", "--dport", str(container_port),
-            "-j", "ACCEPT"
-        ], check=True)
-        
-        subprocess.run([
-            "iptables", "-A", "FORWARD",  # Changed from -I to -A (append)
-            "-s", container_ip, "-p", "tcp", "--sport", str(container_port),
-            "-j", "ACCEPT"
-        ], check=True)
+        if not use_ipset:
+            rules.append(("filter", [
+                "FORWARD", "-d", container_ip, "-p", "tcp", "--dport", str(container_port),
+                "-j", "ACCEPT"
+            ]))
+            rules.append(("filter", [
+                "FORWARD", "-s", container_ip, "-p", "tcp", "--sport", str(container_port),
+                "-j", "ACCEPT"
+            ]))
         
         # DNAT rules
-        subprocess.run([
-            "iptables", "-t", "nat", "-A", "PREROUTING",
-            "-p", "tcp", "--dport", str(host_port),
+        rules.append(("nat", [
+            "PREROUTING", "-p", "tcp", "--dport", str(host_port),
             "-j", "DNAT", "--to-destination", f"{container_ip}:{container_port}"
-        ], check=True)
-        
-        subprocess.run([
-            "iptables", "-t", "nat", "-A", "OUTPUT",
-            "-p", "tcp", "-d", "127.0.0.1", "--dport", str(host_port),
+        ]))
+        rules.append(("nat", [
+            "OUTPUT", "-p", "tcp", "-d", "127.0.0.1", "--dport", str(host_port),
             "-j", "DNAT", "--to-destination", f"{container_ip}:{container_port}"
-        ], check=True)
+        ]))
         
         # MASQUERADE rule
-        subprocess.run([
-            "iptables", "-t", "nat", "-A", "POSTROUTING",
-            "-p", "tcp", "-d", container_ip, "--dport", str(container_port),
+        rules.append(("nat", [
+            "POSTROUTING", "-p", "tcp", "-d", container_ip, "--dport", str(container_port),
             "-j", "MASQUERADE"
-        ], check=True)
-        
+        ]))
+    return rules
+
+def _iptables_restore(action: str, rules: List[tuple[str, List[str]]], check: bool = True) -> bool:
+    """
+    Apply all rules with a single iptables-restore --noflush call instead of
+    one iptables process per rule. action is '-A' or '-D'.
+    """
+    tables: Dict[str, List[str]] = {}
+    for table, rule in rules:
+        tables.setdefault(table, []).append(" ".join([action] + rule))
+    
+    ruleset = ""
+    for table, lines in tables.items():
+        ruleset += f"*{table}\n" + "\n".join(lines) + "\nCOMMIT\n"
+    
+    result = subprocess.run(
+        ["iptables-restore", "--noflush", "--wait"],
+        input=ruleset, text=True, check=check
+    )
+    return result.returncode == 0
+
+def _ipset_restore(command: str, port_mappings: List[tuple[int, int]], container_ip: str):
+    """Add or delete (container_ip, tcp port) members of PORTS_IPSET in one ipset call."""
+    members = "".join(
+        f"{command} {PORTS_IPSET} {container_ip},tcp:{container_port}\n"
+        for _, container_port in port_mappings
+    )
+    # -exist makes re-adding or deleting a missing member a no-op
+    subprocess.run(["ipset", "restore", "-exist"], input=members, text=True, check=command == "add")
+
+def setup_port_forwarding(port_mappings: List[tuple[int, int]], container_ip: str):
+    """Set up port forwarding using iptables for localhost access."""
+    
+    # Enable route_localnet to allow DNAT from localhost to work properly
+    _sysctl('net.ipv4.conf.lo.route_localnet', '1')
+    _sysctl('net.ipv4.conf.all.route_localnet', '1')
+    
+    if _ensure_ports_ipset():
+        _ipset_restore("add", port_mappings, container_ip)
+    _iptables_restore("-A", _port_forwarding_rules(port_mappings, container_ip))
+    
+    for host_port, container_port in port_mappings:
         print(f"🔌 Port forwarding: localhost:{host_port} → {container_ip}:{container_port}")
             
 
 def cleanup_port_forwarding(port_mappings: List[tuple[int, int]], container_ip: str):
     """Clean up iptables port forwarding rules."""
-    for host_port, container_port in port_mappings:
-        # Clean up NAT rules
-        subprocess.run([
-            'iptables', '-t', 'nat', '-D', 'PREROUTING',
-            '-p', 'tcp', '--dport', str(host_port),
-            '-j', 'DNAT', '--to-destination', f'{container_ip}:{container_port}'
-        ], check=False)
-        
-        subprocess.run([
-            'iptables', '-t', 'nat', '-D', 'OUTPUT',
-            '-p', 'tcp', '-d', '127.0.0.1', '--dport', str(host_port),
-            '-j', 'DNAT', '--to-destination', f'{container_ip}:{container_port}'
-        ], check=False)
-        
-        subprocess.run([
-            'iptables', '-t', 'nat', '-D', 'POSTROUTING',
-            '-p', 'tcp', '-d', container_ip, '--dport', str(container_port),
-            '-j', 'MASQUERADE'
-        ], check=False)
-        
-        # Clean up FORWARD rules
-        subprocess.run([
-            'iptables', '-D', 'FORWARD',
-            '-s', container_ip, '-p', 'tcp', '--sport', str(container_port),
-            '-j', 'ACCEPT'
-        ], check=False)
-        
-        subprocess.run([
-            'iptables', '-D', 'FORWARD',
-            '-d', container_ip, '-p', 'tcp', '--dport', str(container_port),
-            '-j', 'ACCEPT'
-        ], check=False)
+    rules = list(reversed(_port_forwarding_rules(port_mappings, container_ip)))
+    
+    if not _iptables_restore("-D", rules, check=False):
+        # A rule went missing, so the batch was rejected as a whole: delete one by one
+        for table, rule in rules:
+            subprocess.run(["iptables", "-t", table, "-D"] + rule, check=False)
+    
+    if _ensure_ports_ipset():
+        _ipset_restore("del", port_mappings, container_ip)
     
     print("🧹 Cleaned up iptables rules")
 
 def enable_bridge_forwarding():
     """Enable IP forwarding and configure iptables for container networking."""
-    # Enable IP forwarding
-    subprocess.run(['sysctl', '-w', 'net.ipv4.ip_forward=1'], check=False)
+    global _ports_ipset_ok
     
-    # Check and add bridge forwarding rule for traffic on the bridge subnet
-    check_rule = subprocess.run([
-        'iptables', '-C', 'FORWARD',
-        '-s', '69.69.0.0/24', '-d', '69.69.0.0/24',
-        '-j', 'ACCEPT'
-    ], capture_output=True)
+    # Enable IP forwarding
+    _sysctl('net.ipv4.ip_forward', '1')
     
-    if check_rule.returncode != 0:
-        subprocess.run([
-            'iptables', '-I', 'FORWARD', '1',
-            '-s', '69.69.0.0/24', '-d', '69.69.0.0/24',
-            '-j', 'ACCEPT'
-        ], check=True)
+    # All shocker FORWARD rules live in our own chain. Declaring it in an
+    # iptables-restore --noflush batch creates or flushes it, so the whole chain
+    # is rewritten idempotently in one call, with no -C probe per rule
+    def restore_chain(rules: List[str], check: bool) -> bool:
+        ruleset = (
+            "*filter\n"
+            f":{FORWARD_CHAIN} - [0:0]\n"
+            + "".join(f"-A {FORWARD_CHAIN} {rule}\n" for rule in rules)
+            + "COMMIT\n"
+        )
+        return subprocess.run(
+            ['iptables-restore', '--noflush', '--wait'], input=ruleset, text=True, check=check
+        ).returncode == 0
     
-    # Check and add established connections rule
-    check_established = subprocess.run([
-        'iptables', '-C', 'FORWARD',
-        '-m', 'state', '--state', 'RELATED,ESTABLISHED',
-        '-j', 'ACCEPT'
-    ], capture_output=True)
+    rules = [
+        f"-s {BRIDGE_SUBNET} -d {BRIDGE_SUBNET} -j ACCEPT",
+        "-m state --state RELATED,ESTABLISHED -j ACCEPT",
+    ]
+    # Published container ports live in one ipset, so these rules don't
+    # grow with every container
+    set_rules = [
+        f"-m set --match-set {PORTS_IPSET} dst,dst -j ACCEPT",
+        f"-m set --match-set {PORTS_IPSET} src,src -j ACCEPT",
+    ]
+    if _ensure_ports_ipset() and not restore_chain(rules + set_rules, check=False):
+        print("⚠️  iptables set match (xt_set) unavailable, falling back to per-port FORWARD rules")
+        _ports_ipset_ok = False
+    if not _ports_ipset_ok:
+        restore_chain(rules, check=True)
     
-    if check_established.returncode != 0:
-        subprocess.run([
-            'iptables', '-I', 'FORWARD', '2',
-            '-m', 'state', '--state', 'RELATED,ESTABLISHED',
-            '-j', 'ACCEPT'
-        ], check=True)
+    # Hook the chain into FORWARD once
+    jump = ['FORWARD', '-j', FORWARD_CHAIN]
+    if subprocess.run(['iptables', '-C'] + jump, capture_output=True).returncode != 0:
+        subprocess.run(['iptables', '-I', 'FORWARD', '1'] + jump[1:], check=True)
     
     print(f"🔀 Enabled forwarding for {BRIDGE_NAME}")
@@ -1,20 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
-import tarfile
-import shutil
 import os
 import subprocess
 from pathlib import Path
 from typing import List, Dict, Optional
 
 from shocker.docker_registry import ARTIFACTS_DIR
-from shocker.networking import BRIDGE_NAME, cleanup_network_namespace, setup_dns, setup_network_namespace, setup_port_forwarding, cleanup_port_forwarding
+from shocker import layer_store, netns_pool
+from shocker.networking import BRIDGE_NAME, NETNS_DIR, setup_dns, setup_port_forwarding, cleanup_port_forwarding
 from shocker.container_registry import ContainerRegistry
 
+# Default container environment with simple prompt
+BASE_ENV = {
+    "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+    "HOME": "/root",
+    "PS1": "container# ",  # Simple prompt
+    "SHELL": "/bin/sh",
+    "TERM": "xterm"
+}
+
 def chroot_execute(root_path: Path, command: List[str], 
                    env_vars: Dict[str, str] | None = None, 
                    netns_name: str | None = None) -> subprocess.CompletedProcess | None:
     """
-    Execute a command in a chroot environment using system chroot command.
+    Execute a command in a chroot environment (and network namespace).
+    
+    The forked child joins the namespace and chroots itself right before exec,
+    instead of going through `ip netns exec` and `chroot(1)`.
     
     Args:
         root_path: Path to the new root directory
@@ -23,26 +35,31 @@ def chroot_execute(root_path: Path, command: List[str],
         interactive: Whether to run interactively
         netns_name: Network namespace to run in (optional)
     """
-    # Build environment
-    env = os.environ.copy()
-    if env_vars:
-        env.update(env_vars)
-    
-    # Default container environment with simple prompt
-    env.update({
-        "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
-        "HOME": "/root",
-        "PS1": "container# ",  # Simple prompt
-        "SHELL": "/bin/sh",
-        "TERM": "xterm"
-    })
+    # Build environment: host env, container defaults, then caller overrides
+    env = {**os.environ, **BASE_ENV, **(env_vars or {})}
     
+    # Like chroot(1): no command means an interactive shell
+    command = list(command) or [env["SHELL"], "-i"]
 
-    chroot_cmd = ["ip", "netns", "exec", netns_name, "chroot", str(root_path)] + list(command)
-    
-    print(f"🔧 Executing: {' '.join(chroot_cmd)}")
+    # Resolve the namespace in the parent: a missing namespace raises here as a
+    # normal exception, and the child only has to setns() on an open fd.
+    # O_CLOEXEC keeps the fd out of the container once it execs
+    netns_fd = os.open(NETNS_DIR / netns_name, os.O_RDONLY | os.O_CLOEXEC) if netns_name else None
+
+    def enter_container():
+        # Runs in the child between fork and exec
+        if netns_fd is not None:
+            os.setns(netns_fd, os.CLONE_NEWNET)
+        os.chroot(root_path)
+        os.chdir("/")
+
+    print(f"🔧 Executing in {root_path} (netns {netns_name}): {' '.join(command)}")
     
-    result = subprocess.run(chroot_cmd, env=env, check=True)
+    try:
+        result = subprocess.run(command, env=env, check=True, preexec_fn=enter_container)
+    finally:
+        if netns_fd is not None:
+            os.close(netns_fd)
 
     return result
 
@@ -68,34 +85,37 @@ def run_container(repository: str, tag: str, command: List[str],
     if not layer_files:
         raise FileNotFoundError(f"No layer files found in {image_dir}")
     
-    print(f"Found {len(layer_files)} layers to extract...")
+    print(f"Found {len(layer_files)} layers...")
     
     # Create temporary directory for the container filesystem
     temp_dir = Path(tempfile.mkdtemp(prefix="shocker_", dir="/tmp"))
-    rootfs_path = temp_dir
-    
-    print(f"Created temporary container filesystem at: {rootfs_path}")
+    rootfs_path = temp_dir / "rootfs"
     
-    # Allocate IP from registry and setup network
-    container_ip = ContainerRegistry.allocate_ip()
-    netns_name = f"shocker-{temp_dir.name}"
-    setup_network_namespace(netns_name, container_ip)
+    print(f"Created temporary container directory at: {temp_dir}")
     
-    # Register container if named
-    if container_name:
-        ContainerRegistry.register(container_name, container_ip, netns_name)
-        print(f"📝 Registered container '{container_name}' with IP {container_ip}")
-    
-    if port_mappings:
-        setup_port_forwarding(port_mappings, container_ip)
+    # Take a pre-warmed network namespace, or allocate an IP and set one up
+    network = netns_pool.acquire(f"shocker-{temp_dir.name}")
+    netns_name, container_ip = network.netns_name, network.container_ip
     
+    # The network is released in the finally below, so a failure in any later
+    # step (e.g. a duplicate name) can't leak the IP, namespace or veth
+    registered = forwarding = False
     try:
-        # Extract all layers in order
-        for i, layer_file in enumerate(layer_files, 1):
-            print(f"[{i}/{len(layer_files)}] Extracting {layer_file.name}...")
-
-            with tarfile.open(layer_file, 'r:gz') as tar:
-                tar.extractall(path=rootfs_path)
+        # Register container if named
+        if container_name:
+            ContainerRegistry.register(container_name, container_ip, netns_name)
+            registered = True
+            print(f"📝 Registered container '{container_name}' with IP {container_ip}")
+        
+        if port_mappings:
+            setup_port_forwarding(port_mappings, container_ip)
+            forwarding = True
+        
+        # Each layer is unpacked into its own store directory, so layers not
+        # seen before can be unpacked in parallel; overlayfs stacks them in order
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(layer_files))) as executor:
+            layer_dirs = list(executor.map(layer_store.unpack, layer_files))
+        layer_store.mount_rootfs(layer_dirs, temp_dir)
         
         print(f"✅ Container filesystem ready at: {rootfs_path}")
         
@@ -117,16 +137,24 @@ def run_container(repository: str, tag: str, command: List[str],
             
     finally:
         # Cleanup port forwarding
-        if port_mappings:
+        if forwarding:
             cleanup_port_forwarding(port_mappings, container_ip)
         
         # Unregister container if named
-        if container_name:
+        if registered:
             ContainerRegistry.unregister(container_name)
             print(f"🗑️  Unregistered container '{container_name}'")
         
-        cleanup_network_namespace(netns_name)
+        # Pooled namespaces keep their IP, others are torn down and release it
+        netns_pool.release(network)
         
-        # Clean up temporary directory
-        print(f"\n🧹 Cleaning up temporary directory: {temp_dir}")
-        shutil.rmtree(temp_dir)
+        # Clean up temporary directory, the shared layers stay in the store
+        if layer_store.unmount_rootfs(rootfs_path):
+            # rm's C unlink loop is much faster than rmtree on a rootfs of many small files,
+            # and running it detached lets run return as soon as the container exits
+            print(f"\n🧹 Cleaning up temporary directory: {temp_dir}")
+            subprocess.Popen(['rm', '-rf', '--one-file-system', str(temp_dir)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+        else:
+            print(f"\n⚠️  Leaving {temp_dir} in place, its overlay is still in use")